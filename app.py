@@ -1,19 +1,45 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
-import base64
+import asyncio
+import atexit
+import hashlib
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 import os
+import queue
+import random
+import re
+import sqlite3
+import tempfile
+import threading
 import time
 import uuid
+from xml.sax.saxutils import escape
+
+import httpx
+import numpy as np
+import orjson
+import tiktoken
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import sqlite_vec # Optional: enables the persistent semantic cache
+except ImportError:
+    sqlite_vec = None
 
 import azure.cognitiveservices.speech as speechsdk
 from azure.cognitiveservices.speech import SpeechConfig, SpeechSynthesizer, ResultReason, CancellationReason, SpeechSynthesisOutputFormat
 from azure.search.documents import SearchClient
 from azure.search.documents.models import VectorizedQuery
 from azure.core.credentials import AzureKeyCredential
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from azure.core.pipeline.transport import RequestsTransport
+from flask import Flask, Response, request, jsonify, render_template, send_from_directory
+from flask_compress import Compress
 from openai import AzureOpenAI
 
 # Environment variables
@@ -24,6 +50,14 @@ PORT = os.environ.get("PORT", "8000") # Default to 8000 if not set
 SPEECH_KEY = os.environ.get("SPEECH_KEY")
 SPEECH_REGION = os.environ.get("SPEECH_REGION")
 
+# Number of speech synthesizers kept warm so concurrent requests don't serialize on one instance
+TTS_POOL = int(os.environ.get("TTS_POOL", "4"))
+# Seconds a request waits for a free synthesizer before giving up on TTS
+TTS_POOL_TIMEOUT = 30
+# Size of the shared thread pool for short blocking SDK calls (search, TTS attempts, completion chunks).
+# A request can have about two calls in flight at once, so the default is twice the request threads per worker.
+BG_WORKERS = int(os.environ.get("BG_WORKERS", 2 * int(os.environ.get("GUNICORN_THREADS", "32"))))
+
 # Azure OpenAI
 AZURE_OPENAI_API_KEY = os.environ.get("AZURE_OPENAI_API_KEY")
 AZURE_OPENAI_ENDPOINT = os.environ.get("AZURE_OPENAI_ENDPOINT")
@@ -42,10 +76,43 @@ AZURE_SEARCH_API_KEY = os.environ.get("AZURE_SEARCH_API_KEY")
 SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION = "true"  ##os.environ.get("SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION", "True").lower() == "true"
 # This is the voice to be used for TTS if SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION is True.
 VOICE_NAME_CHAT_COMPLETION = "en-US-AvaNeural"  ##os.environ.get("VOICE_NAME_CHAT_COMPLETION", "en-US-AvaNeural")
+# If True, the client uses /chat_stream, which sends the response sentence by sentence while it is generated,
+# each with an audio URL that streams its speech as it is synthesized, instead of waiting for the whole reply.
+SHOULD_STREAM_TTS_CHUNKS = os.environ.get("SHOULD_STREAM_TTS_CHUNKS", "false").lower() == "true"
+# Optional file with one query per line, used to pre-populate the semantic cache at startup.
+SEMANTIC_CACHE_WARMUP_FILE = os.environ.get("SEMANTIC_CACHE_WARMUP_FILE")
+# Optional SQLite file that persists the embeddings and semantic caches across restarts and workers.
+CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH")
+# SQLite file through which /chat and /chat_stream hand audio to /tts/<uid>. Shared by all workers on the host.
+AUDIO_STORE_PATH = os.environ.get("AUDIO_STORE_PATH", os.path.join(tempfile.gettempdir(), "voicechat-audio.db"))
 
 # Constants
+# Azure AI Search index fields, built once rather than per query.
+# SEARCH_SELECT must stay a list: SearchClient.search only honors a str or list and silently ignores other sequences.
+VECTOR_FIELDS = "contentVector"
+SEARCH_SELECT = ["title", "content", "source"]
+# Kept byte-for-byte identical across requests so it forms a cacheable prompt prefix
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful AI assistant."}
 MAX_RETRIES = 3
-RETRY_DELAY = 2  # seconds
+RETRY_BACKOFF_BASE = 0.25  # seconds, doubled on every retry
+RETRY_BACKOFF_CAP = 8  # seconds
+EMBEDDINGS_CACHE_SIZE = 1024 # Max number of query embeddings kept in memory
+SEMANTIC_CACHE_SIZE = 512 # Max number of past queries whose search results are kept in memory
+SEMANTIC_CACHE_THRESHOLD = 0.92 # Minimum cosine similarity for a past query's results to be reused
+SEMANTIC_CACHE_TTL = 300 # seconds
+SEMANTIC_CACHE_SCAN_BLOCK = 256 # Cached rows widened to float32 at a time during a similarity scan
+MAX_HISTORY_TOKENS = 4096 # Oldest turns are dropped once the conversation history exceeds this
+SUMMARIZE_AFTER_TURNS = 20 # Longer histories are condensed into a summary message
+SUMMARY_KEEP_RECENT_TURNS = 6 # Most recent turns kept verbatim when summarizing
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+STS_TOKEN_LIFETIME = 600 # seconds a Speech authorization token is valid
+STS_TOKEN_REFRESH_AFTER = 540 # seconds; a cached token is never handed out with less than a minute left
+CACHE_DB_MAX_EMBEDDINGS = 100000 # Rows kept in the persistent embeddings table per embeddings deployment
+CACHE_DB_PURGE_INTERVAL = 60 # seconds between purges of expired or excess rows in the cache database
+AUDIO_STORE_TTL = 900 # seconds an audio URL stays valid; outlasts playback of the longest reply (max_tokens=800) queued ahead of it
+EMBEDDINGS_BATCH_SIZE = 16 # Max texts sent per embeddings request when warming the semantic cache
+TTS_STREAM_CHUNK_SIZE = 4096 # bytes of audio read from the synthesizer per streamed chunk
+SENTENCE_BOUNDARY = re.compile(r"[.!?\n]\s") # Where a streamed completion can be cut for early TTS
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -53,6 +120,16 @@ logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__, static_folder='static', template_folder='static')
+app.json.compact = True # No indentation in jsonify responses
+# Gzip JSON chat responses (text, snippets, conversation history). Audio from /tts is already-compressed MP3
+# and the /chat_stream NDJSON must not be buffered, so neither mimetype is listed.
+app.config["COMPRESS_MIMETYPES"] = ["application/json"]
+app.config["COMPRESS_LEVEL"] = 4 # Balances CPU time against compression ratio
+Compress(app)
+
+# One bounded pool for all background work, instead of threads spawned per request
+EXECUTOR = ThreadPoolExecutor(max_workers=BG_WORKERS, thread_name_prefix="bg")
+atexit.register(EXECUTOR.shutdown, wait=False)
 
 # Initialize Azure clients
 # Speech SDK configuration
@@ -60,7 +137,22 @@ if not SPEECH_KEY or not SPEECH_REGION:
     raise ValueError("SPEECH_KEY and SPEECH_REGION must be set.")
 speech_config = speechsdk.SpeechConfig(subscription=SPEECH_KEY, region=SPEECH_REGION)
 speech_config.set_speech_synthesis_output_format(SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3) # Standard audio format
-speech_synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None) # audio_config=None for in-memory synthesis
+# Synthesizers are expensive to create, so a fixed pool is built up front and shared across requests
+SYNTH_POOL = queue.Queue()
+for _ in range(TTS_POOL):
+    SYNTH_POOL.put(speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)) # audio_config=None for in-memory synthesis
+
+# Shared keep-alive HTTP connections, so back-to-back calls within a /chat request skip the TLS handshake
+HTTP_MAX_CONNECTIONS = 128
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 64
+shared_http_client = httpx.Client(
+    http2=True, # Multiplexes concurrent Azure OpenAI requests over one connection
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS)
+)
+# azure-core has no httpx transport, so Azure AI Search gets a pooled requests session instead
+shared_http_session = requests.Session()
+shared_http_session.mount("https://", HTTPAdapter(pool_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS, pool_maxsize=HTTP_MAX_KEEPALIVE_CONNECTIONS))
 
 # Azure OpenAI client
 if not AZURE_OPENAI_API_KEY or not AZURE_OPENAI_ENDPOINT or not AZURE_OPENAI_DEPLOYMENT_NAME or not AZURE_OPENAI_EMBEDDINGS_DEPLOYMENT_NAME:
@@ -68,7 +160,8 @@ if not AZURE_OPENAI_API_KEY or not AZURE_OPENAI_ENDPOINT or not AZURE_OPENAI_DEP
 openai_client = AzureOpenAI(
     api_key=AZURE_OPENAI_API_KEY,
     api_version="2024-12-01-preview", # Recommended API version
-    azure_endpoint=AZURE_OPENAI_ENDPOINT
+    azure_endpoint=AZURE_OPENAI_ENDPOINT,
+    http_client=shared_http_client
 )
 
 # Azure AI Search client
@@ -78,7 +171,8 @@ if AZURE_SEARCH_SERVICE_ENDPOINT and AZURE_SEARCH_INDEX_NAME and AZURE_SEARCH_AP
         search_client = SearchClient(
             endpoint=AZURE_SEARCH_SERVICE_ENDPOINT,
             index_name=AZURE_SEARCH_INDEX_NAME,
-            credential=AzureKeyCredential(AZURE_SEARCH_API_KEY)
+            credential=AzureKeyCredential(AZURE_SEARCH_API_KEY),
+            transport=RequestsTransport(session=shared_http_session, session_owner=False)
         )
         logger.info(f"Successfully connected to Azure AI Search index '{AZURE_SEARCH_INDEX_NAME}'.")
     except Exception as e:
@@ -88,127 +182,734 @@ else:
     logger.warning("Azure AI Search environment variables not fully set. Search functionality will be disabled.")
 
 
+def _to_unit_vector(embedding):
+    """Converts an embedding to a read-only, L2-normalized float32 array so cosine similarity is a plain dot product."""
+    vector = np.asarray(embedding, dtype=np.float32)
+    vector /= np.linalg.norm(vector) + 1e-12
+    vector.flags.writeable = False # Cached and shared between requests
+    return vector
+
+class PersistentCache:
+    """
+    SQLite-backed store for query embeddings and, when the sqlite-vec extension is installed, semantic search results.
+    Rows are namespaced by embeddings deployment, so switching models never returns stale vectors.
+    """
+
+    def __init__(self, path, model):
+        self.model = model
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._vec_table = None
+        self._last_embeddings_purge = 0.0
+        self._last_results_purge = 0.0
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL") # Lets several workers read while one writes
+            self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT, text_sha256 TEXT, vec BLOB, created_at REAL, PRIMARY KEY (model, text_sha256))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_created_at ON embeddings (model, created_at)")
+            if sqlite_vec:
+                try:
+                    # Python builds without extension support lack enable_load_extension (AttributeError)
+                    self._conn.enable_load_extension(True)
+                    sqlite_vec.load(self._conn)
+                    self._conn.enable_load_extension(False)
+                    self._conn.execute("CREATE TABLE IF NOT EXISTS semantic_results (id INTEGER PRIMARY KEY AUTOINCREMENT, model TEXT, documents TEXT, created_at REAL)")
+                    self._conn.execute("CREATE INDEX IF NOT EXISTS semantic_results_created_at ON semantic_results (model, created_at)")
+                    self._vec_table = "vec_queries_" + hashlib.sha256(model.encode('utf-8')).hexdigest()[:12]
+                except (AttributeError, sqlite3.Error) as e:
+                    logger.warning(f"Could not load sqlite-vec: {e}")
+        if not self._vec_table:
+            logger.warning("sqlite-vec is not available. Only exact-match embeddings will be persisted.")
+
+    def get_embedding(self, text):
+        """Returns the stored embedding for text, or None."""
+        key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        with self._lock:
+            row = self._conn.execute("SELECT vec FROM embeddings WHERE model = ? AND text_sha256 = ?", (self.model, key)).fetchone()
+        return np.frombuffer(row[0], dtype=np.float32) if row else None # Stored normalized; frombuffer is read-only like cached arrays
+
+    def put_embedding(self, text, embedding):
+        """Stores an embedding for text, periodically trimming the table to the newest CACHE_DB_MAX_EMBEDDINGS rows."""
+        key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO embeddings (model, text_sha256, vec, created_at) VALUES (?, ?, ?, ?)", (self.model, key, embedding.tobytes(), now))
+            if now - self._last_embeddings_purge > CACHE_DB_PURGE_INTERVAL:
+                self._last_embeddings_purge = now
+                # The subquery yields NULL (nothing deleted) while the table is under the cap
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE model = ? AND created_at < "
+                    "(SELECT created_at FROM embeddings WHERE model = ? ORDER BY created_at DESC LIMIT 1 OFFSET ?)",
+                    (self.model, self.model, CACHE_DB_MAX_EMBEDDINGS - 1)
+                )
+
+    def _ensure_vec_table(self, dimensions):
+        self._conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {self._vec_table} USING vec0(embedding float[{dimensions}])")
+
+    def nearest_documents(self, embedding, threshold, ttl):
+        """Returns documents stored for the nearest past query if it is similar enough and not expired, else None."""
+        if not self._vec_table:
+            return None
+        with self._lock, self._conn:
+            self._ensure_vec_table(embedding.shape[0])
+            row = self._conn.execute(f"SELECT rowid, distance FROM {self._vec_table} WHERE embedding MATCH ? AND k = 1", (embedding.tobytes(),)).fetchone()
+            if not row:
+                return None
+            rowid, distance = row
+            # Vectors are unit length, so cosine similarity follows from the L2 distance
+            if 1 - distance * distance / 2 < threshold:
+                return None
+            documents, created_at = self._conn.execute("SELECT documents, created_at FROM semantic_results WHERE id = ?", (rowid,)).fetchone()
+            if time.time() - created_at > ttl:
+                self._conn.execute(f"DELETE FROM {self._vec_table} WHERE rowid = ?", (rowid,))
+                self._conn.execute("DELETE FROM semantic_results WHERE id = ?", (rowid,))
+                return None
+        return json.loads(documents)
+
+    def put_documents(self, embedding, documents, ttl):
+        """
+        Stores search results for a query embedding. Entries older than ttl are purged periodically,
+        so the brute-force KNN scan in nearest_documents only covers live entries.
+        """
+        if not self._vec_table:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            self._ensure_vec_table(embedding.shape[0])
+            rowid = self._conn.execute("INSERT INTO semantic_results (model, documents, created_at) VALUES (?, ?, ?)", (self.model, json.dumps(documents), now)).lastrowid
+            self._conn.execute(f"INSERT INTO {self._vec_table} (rowid, embedding) VALUES (?, ?)", (rowid, embedding.tobytes()))
+            if now - self._last_results_purge > CACHE_DB_PURGE_INTERVAL:
+                self._last_results_purge = now
+                self._conn.execute(
+                    f"DELETE FROM {self._vec_table} WHERE rowid IN (SELECT id FROM semantic_results WHERE model = ? AND created_at < ?)",
+                    (self.model, now - ttl)
+                )
+                self._conn.execute("DELETE FROM semantic_results WHERE model = ? AND created_at < ?", (self.model, now - ttl))
+
+persistent_cache = None
+if CACHE_DB_PATH:
+    try:
+        persistent_cache = PersistentCache(CACHE_DB_PATH, AZURE_OPENAI_EMBEDDINGS_DEPLOYMENT_NAME)
+        logger.info(f"Persisting caches to '{CACHE_DB_PATH}'.")
+    except Exception as e:
+        logger.error(f"Failed to open cache database: {e}")
+        persistent_cache = None # Fall back to in-memory caching only
+
+@lru_cache(maxsize=EMBEDDINGS_CACHE_SIZE)
+def _embed_cached(text):
+    """
+    Returns the embedding of already-normalized text, from the persistent cache if possible, else from Azure OpenAI.
+    Results are cached in memory as read-only arrays.
+    """
+    if persistent_cache:
+        try:
+            embedding = persistent_cache.get_embedding(text)
+            if embedding is not None:
+                return embedding
+        except Exception as e:
+            logger.error(f"Error reading persistent embeddings cache: {e}")
+    response = openai_client.embeddings.create(input=text, model=AZURE_OPENAI_EMBEDDINGS_DEPLOYMENT_NAME)
+    embedding = _to_unit_vector(response.data[0].embedding)
+    if persistent_cache:
+        try:
+            persistent_cache.put_embedding(text, embedding)
+        except Exception as e:
+            logger.error(f"Error writing persistent embeddings cache: {e}")
+    return embedding
+
 def generate_embeddings(text):
-    """Generates embeddings for the given text using Azure OpenAI."""
+    """Generates an L2-normalized float32 embedding for the given text using Azure OpenAI."""
     if not openai_client:
         logger.error("OpenAI client not initialized for embeddings.")
         return None
     try:
-        response = openai_client.embeddings.create(input=text, model=AZURE_OPENAI_EMBEDDINGS_DEPLOYMENT_NAME)
-        return response.data[0].embedding
+        # Normalize before hitting the cache so trivially different inputs share an entry
+        return _embed_cached(text.strip().lower())
     except Exception as e:
         logger.error(f"Error generating embeddings: {e}")
         return None
 
+def generate_embeddings_batch(texts):
+    """Generates L2-normalized float32 embeddings for several texts with a single Azure OpenAI request. Returns None on failure."""
+    if not openai_client:
+        logger.error("OpenAI client not initialized for embeddings.")
+        return None
+    try:
+        response = openai_client.embeddings.create(input=[text.strip().lower() for text in texts], model=AZURE_OPENAI_EMBEDDINGS_DEPLOYMENT_NAME)
+        # The service may return items out of order, so place them by index
+        embeddings = [None] * len(texts)
+        for item in response.data:
+            embeddings[item.index] = _to_unit_vector(item.embedding)
+        return embeddings
+    except Exception as e:
+        logger.error(f"Error generating batch embeddings: {e}")
+        return None
+
+class SemanticCache:
+    """
+    Keeps the embeddings of recent queries alongside their search results.
+    A new query whose embedding is close enough (cosine similarity) to a cached one reuses its results.
+    If a PersistentCache is given as store, entries are also written to it and looked up there on in-memory misses.
+    """
+
+    def __init__(self, capacity=SEMANTIC_CACHE_SIZE, threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEMANTIC_CACHE_TTL, store=None):
+        self.store = store
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # L2-normalized embeddings are stored int8-quantized with a per-row scale: 4x less memory (and memory traffic per scan) than float32
+        self._embeddings = None # (capacity x dimensions) int8 matrix, allocated on first insert
+        self._scales = np.zeros(capacity, dtype=np.float32)
+        self._documents = [None] * capacity
+        self._timestamps = np.zeros(capacity, dtype=np.float64) # 0 marks an empty slot
+        self._next_slot = 0 # Ring-buffer write position
+        self._lock = threading.Lock()
+
+    def _lookup_memory(self, embedding):
+        with self._lock:
+            if self._embeddings is None or self._embeddings.shape[1] != embedding.shape[0]:
+                return None
+            # Lazily evict expired entries
+            expired = (self._timestamps > 0) & (time.time() - self._timestamps > self.ttl)
+            for slot in np.flatnonzero(expired):
+                self._timestamps[slot] = 0
+                self._documents[slot] = None
+            # Triage with the quantized query. NumPy has no BLAS path for int8, so rows are widened to float32
+            # block by block; the converted block stays in cache while only int8 data is read from memory.
+            query_int8, query_scale = self._quantize(embedding)
+            query_int8 = query_int8.astype(np.float32)
+            similarities = np.empty(self.capacity, dtype=np.float32)
+            for start in range(0, self.capacity, SEMANTIC_CACHE_SCAN_BLOCK):
+                block = self._embeddings[start:start + SEMANTIC_CACHE_SCAN_BLOCK]
+                similarities[start:start + SEMANTIC_CACHE_SCAN_BLOCK] = block.astype(np.float32) @ query_int8
+            similarities *= self._scales * query_scale
+            similarities[self._timestamps == 0] = -np.inf
+            best = int(similarities.argmax())
+            # Re-verify the best candidate against the full-precision query before trusting it
+            if np.isfinite(similarities[best]) and float(self._embeddings[best].astype(np.float32) @ embedding) * self._scales[best] >= self.threshold:
+                return self._documents[best]
+            return None
+
+    @staticmethod
+    def _quantize(embedding):
+        """Scalar-quantizes a vector to int8 with a per-vector scale. Returns (int8 vector, scale)."""
+        scale = float(np.abs(embedding).max()) / 127 + 1e-12
+        return np.round(embedding / scale).astype(np.int8), scale
+
+    def lookup(self, embedding):
+        """
+        Returns cached documents for the most similar live query, or None on a miss.
+        embedding must already be L2-normalized, as returned by generate_embeddings.
+        """
+        documents = self._lookup_memory(embedding)
+        if documents is None and self.store:
+            try:
+                documents = self.store.nearest_documents(embedding, self.threshold, self.ttl)
+            except Exception as e:
+                logger.error(f"Error reading persistent semantic cache: {e}")
+            if documents is not None:
+                self._put_memory(embedding, documents)
+        with self._lock:
+            if documents is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return documents
+
+    def get(self, query_text):
+        """Embeds the query and looks it up. Returns an (embedding, documents or None) pair."""
+        embedding = generate_embeddings(query_text)
+        if embedding is None:
+            return None, None
+        return embedding, self.lookup(embedding)
+
+    def put(self, embedding, documents):
+        """Stores the search results for an L2-normalized query embedding, overwriting the oldest slot when full."""
+        self._put_memory(embedding, documents)
+        if self.store:
+            try:
+                self.store.put_documents(embedding, documents, self.ttl)
+            except Exception as e:
+                logger.error(f"Error writing persistent semantic cache: {e}")
+
+    def _put_memory(self, embedding, documents):
+        with self._lock:
+            if self._embeddings is None or self._embeddings.shape[1] != embedding.shape[0]:
+                self._embeddings = np.zeros((self.capacity, embedding.shape[0]), dtype=np.int8)
+                self._documents = [None] * self.capacity
+                self._timestamps[:] = 0
+            slot = self._next_slot
+            self._embeddings[slot], self._scales[slot] = self._quantize(embedding)
+            self._documents[slot] = documents
+            self._timestamps[slot] = time.time()
+            self._next_slot = (slot + 1) % self.capacity
+
+    def stats(self):
+        """Returns hit/miss counters and current occupancy."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": int(np.count_nonzero(self._timestamps)), "capacity": self.capacity}
+
+semantic_cache = SemanticCache(store=persistent_cache)
+
+def _vector_search(embeddings, top_n):
+    """Runs a single Azure AI Search request with one vector query per embedding."""
+    # The SDK serializes plain lists, so convert the normalized arrays only at this boundary
+    vector_queries = [VectorizedQuery(vector=embedding.tolist(), k_nearest_neighbors=top_n, fields=VECTOR_FIELDS) for embedding in embeddings]
+    
+    results = search_client.search(
+        search_text=None, # Using vector search, so search_text can be None
+        vector_queries=vector_queries,
+        select=SEARCH_SELECT, # Specify fields to retrieve
+        top=top_n
+    )
+    
+    documents = []
+    for result in results:
+        documents.append({
+            "title": result.get("title", "N/A"),
+            "content": result.get("content", ""),
+            "source": result.get("source", "N/A")
+        })
+    logger.info(f"Found {len(documents)} documents from search.")
+    return documents
+
 def search_documents(query_text, top_n=3):
-    """Performs a vector search on Azure AI Search."""
+    """
+    Performs a vector search on Azure AI Search, reusing results of semantically similar past queries.
+    query_text may also be a list of query variants (e.g. multi-query rewriting); these are embedded in one
+    batch request and searched together, and bypass the semantic cache.
+    """
     if not search_client:
         logger.warning("Search client not available. Skipping document search.")
         return []
     try:
-        vector_query = VectorizedQuery(vector=generate_embeddings(query_text), k_nearest_neighbors=top_n, fields="contentVector")
-        
-        results = search_client.search(
-            search_text=None, # Using vector search, so search_text can be None
-            vector_queries=[vector_query],
-            select=["title", "content", "source"] # Specify fields to retrieve
-        )
-        
-        documents = []
-        for result in results:
-            documents.append({
-                "title": result.get("title", "N/A"),
-                "content": result.get("content", ""),
-                "source": result.get("source", "N/A")
-            })
-        logger.info(f"Found {len(documents)} documents from search.")
+        if isinstance(query_text, list):
+            embeddings = generate_embeddings_batch(query_text)
+            return _vector_search(embeddings, top_n) if embeddings else []
+
+        embedding, cached_documents = semantic_cache.get(query_text)
+        if cached_documents is not None:
+            logger.info(f"Semantic cache hit. Reusing {len(cached_documents)} documents.")
+            return cached_documents
+
+        documents = _vector_search([embedding], top_n)
+        if embedding is not None and documents:
+            semantic_cache.put(embedding, documents)
         return documents
     except Exception as e:
         logger.error(f"Error searching documents: {e}")
         return []
 
-def tts_ssml_and_send_audio_if_needed(text_to_speak, voice_name=VOICE_NAME_CHAT_COMPLETION):
+def warm_semantic_cache(queries, top_n=3):
+    """Pre-populates the semantic cache with search results for the given queries, embedding them in batches."""
+    if not search_client:
+        return
+    warmed = 0
+    for start in range(0, len(queries), EMBEDDINGS_BATCH_SIZE):
+        batch = queries[start:start + EMBEDDINGS_BATCH_SIZE]
+        embeddings = generate_embeddings_batch(batch)
+        if not embeddings:
+            continue
+        for embedding in embeddings:
+            try:
+                documents = _vector_search([embedding], top_n)
+            except Exception as e:
+                logger.error(f"Error warming semantic cache: {e}")
+                continue
+            if documents:
+                semantic_cache.put(embedding, documents)
+                warmed += 1
+    logger.info(f"Warmed semantic cache with {warmed} of {len(queries)} queries.")
+
+def _warm_semantic_cache_from_file(path):
+    """Reads one query per line from path and warms the semantic cache with them."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            queries = [line.strip() for line in f if line.strip()]
+    except OSError as e:
+        logger.error(f"Could not read semantic cache warm-up file '{path}': {e}")
+        return
+    warm_semantic_cache(queries)
+
+if SEMANTIC_CACHE_WARMUP_FILE:
+    # Warm up in the background so startup is not blocked on Azure round-trips
+    EXECUTOR.submit(_warm_semantic_cache_from_file, SEMANTIC_CACHE_WARMUP_FILE)
+
+@contextmanager
+def pooled_synthesizer():
     """
-    Synthesizes speech from text using SSML and returns base64 encoded audio data.
-    Only synthesizes if SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION is True.
+    Borrows a speech synthesizer from SYNTH_POOL and returns it afterwards.
+    Waits up to TTS_POOL_TIMEOUT seconds for one to become free, then raises queue.Empty.
     """
-    if not SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION:
-        return None
+    synthesizer = SYNTH_POOL.get(timeout=TTS_POOL_TIMEOUT)
+    try:
+        yield synthesizer
+    finally:
+        SYNTH_POOL.put(synthesizer)
+
+SSML_SUFFIX = "</voice></speak>"
+_ssml_prefixes = {} # voice name -> opening SSML tags
 
-    ssml = f"<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xml:lang='en-US'><voice name='{voice_name}'>{text_to_speak}</voice></speak>"
+def build_ssml(text_to_speak, voice_name=VOICE_NAME_CHAT_COMPLETION):
+    """Wraps XML-escaped text in the SSML envelope for the given voice."""
+    prefix = _ssml_prefixes.get(voice_name)
+    if prefix is None:
+        voice_attribute = escape(voice_name, {"'": "&apos;"})
+        prefix = f"<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xml:lang='en-US'><voice name='{voice_attribute}'>"
+        _ssml_prefixes[voice_name] = prefix
+    # Unescaped '&' or '<' from the model would make the SSML invalid and fail synthesis
+    return prefix + escape(text_to_speak) + SSML_SUFFIX
+
+# Cancellation error codes worth retrying; anything else (auth, bad request, ...) fails fast
+TRANSIENT_TTS_ERROR_CODES = {
+    speechsdk.CancellationErrorCode.TooManyRequests,
+    speechsdk.CancellationErrorCode.ConnectionFailure,
+    speechsdk.CancellationErrorCode.ServiceTimeout,
+    speechsdk.CancellationErrorCode.ServiceError,
+    speechsdk.CancellationErrorCode.ServiceUnavailable,
+}
+
+def _speak_ssml(ssml):
+    """Runs one blocking synthesis attempt on a pooled synthesizer."""
+    with pooled_synthesizer() as synthesizer:
+        return synthesizer.speak_ssml_async(ssml).get()
+
+def _retry_delay(attempt):
+    """Exponential backoff with jitter, so concurrent clients don't retry in lockstep."""
+    return min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+async def synthesize_speech(text_to_speak, voice_name=VOICE_NAME_CHAT_COMPLETION):
+    """
+    Synthesizes speech from text using SSML and returns the raw MP3 audio data, or None on failure.
+    Transient failures are retried with backoff without blocking the worker.
+    """
+    ssml = build_ssml(text_to_speak, voice_name)
     logger.info(f"Synthesizing SSML: {ssml[:100]}...") # Log start of SSML
+    loop = asyncio.get_running_loop()
 
     for attempt in range(MAX_RETRIES):
         try:
-            result = speech_synthesizer.speak_ssml_async(ssml).get()
+            result = await loop.run_in_executor(EXECUTOR, _speak_ssml, ssml)
             if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
                 audio_data = result.audio_data
                 logger.info(f"Speech synthesis completed. Audio data length: {len(audio_data)} bytes.")
-                return base64.b64encode(audio_data).decode('utf-8')
+                return audio_data
             elif result.reason == speechsdk.ResultReason.Canceled:
                 cancellation_details = result.cancellation_details
                 logger.error(f"Speech synthesis canceled: {cancellation_details.reason}")
-                if cancellation_details.reason == speechsdk.CancellationReason.Error:
-                    logger.error(f"Error details: {cancellation_details.error_details}")
-                break  # Don't retry on cancellation
+                if cancellation_details.reason != speechsdk.CancellationReason.Error:
+                    break
+                logger.error(f"Error details: {cancellation_details.error_details}")
+                if cancellation_details.error_code not in TRANSIENT_TTS_ERROR_CODES:
+                    break  # Don't retry on non-transient errors such as authentication failures
+            else:
+                break
+        except queue.Empty:
+            # The pool stayed exhausted for TTS_POOL_TIMEOUT; retrying would only outlast the request timeout
+            logger.error("No speech synthesizer became free in time.")
+            break
         except Exception as e:
             logger.error(f"Attempt {attempt + 1} failed for TTS: {e}")
-            if attempt < MAX_RETRIES - 1:
-                time.sleep(RETRY_DELAY)
-            else:
-                logger.error("All TTS retries failed.")
+        if attempt < MAX_RETRIES - 1:
+            await asyncio.sleep(_retry_delay(attempt))
+        else:
+            logger.error("All TTS retries failed.")
     return None
 
+def tts_ssml_stream_audio_chunks(text_to_speak, voice_name=VOICE_NAME_CHAT_COMPLETION):
+    """
+    Synthesizes speech from text using SSML and yields raw MP3 audio chunks as soon as they are produced.
+    Unlike synthesize_speech, this does not wait for the whole utterance to be synthesized.
+    """
+    ssml = build_ssml(text_to_speak, voice_name)
+    logger.info(f"Streaming synthesis of SSML: {ssml[:100]}...")
+
+    # The synthesizer stays checked out until the stream is drained (or the client goes away).
+    # The browser reads the stream progressively while it plays, so audio starts before synthesis finishes.
+    try:
+        with pooled_synthesizer() as synthesizer:
+            completed = False
+            try:
+                result = synthesizer.start_speaking_ssml_async(ssml).get()
+                if result.reason == speechsdk.ResultReason.Canceled:
+                    cancellation_details = result.cancellation_details
+                    logger.error(f"Speech synthesis canceled: {cancellation_details.reason}")
+                    if cancellation_details.reason == speechsdk.CancellationReason.Error:
+                        logger.error(f"Error details: {cancellation_details.error_details}")
+                    return
+
+                stream = speechsdk.AudioDataStream(result)
+                buffer = bytes(TTS_STREAM_CHUNK_SIZE)
+                total_bytes = 0
+                while True:
+                    filled_size = stream.read_data(buffer)
+                    if filled_size == 0:
+                        break
+                    total_bytes += filled_size
+                    yield buffer[:filled_size]
+                completed = True
+
+                if stream.status == speechsdk.StreamStatus.Canceled:
+                    logger.error(f"Speech synthesis stream canceled: {stream.cancellation_details.error_details}")
+                else:
+                    logger.info(f"Streaming speech synthesis completed. Audio data length: {total_bytes} bytes.")
+            except Exception as e:
+                logger.error(f"Streaming TTS failed: {e}")
+            finally:
+                if not completed:
+                    # Don't hand a synthesizer that is still speaking back to the pool
+                    synthesizer.stop_speaking_async().get()
+    except queue.Empty:
+        logger.error("No speech synthesizer became free in time. Skipping streamed TTS.")
+
+
+# Control characters are dropped from snippets, except whitespace ones which become spaces so each document stays on one line
+_SNIPPET_TRANSLATION = {code: None for code in [*range(32), 127]}
+_SNIPPET_TRANSLATION.update({ord("\t"): " ", ord("\n"): " ", ord("\r"): " "})
+
+def format_context(documents):
+    """
+    Formats search results as the "Relevant documents" prompt block.
+    Documents sharing a (source, title) are only included once; the rest keep the search relevance order
+    and a fixed layout, so identical results produce identical bytes.
+    """
+    seen = set()
+    entries = []
+    for doc in documents:
+        title, source = doc.get('title', 'Document'), doc.get('source', 'N/A')
+        if (source, title) in seen:
+            continue
+        seen.add((source, title))
+        snippet = (doc.get('content') or '')[:200].translate(_SNIPPET_TRANSLATION).strip() # Truncate content for brevity
+        entries.append((title, source, snippet))
+    return "Relevant documents:\n" + "\n".join([f"- {title} (Source: {source}): {snippet}..." for title, source, snippet in entries])
+
+
+async def build_chat_messages(user_message, conversation_history):
+    """
+    Builds the message list for the chat completion, augmented with search results if search is available.
+    Search runs concurrently with trimming the history. Returns (messages, trimmed conversation history).
+    """
+    loop = asyncio.get_running_loop()
+    search = loop.run_in_executor(EXECUTOR, search_documents, user_message) if search_client else None
+    conversation_history = await loop.run_in_executor(EXECUTOR, trim_conversation_history, conversation_history)
 
-def handle_chat_request(user_message, conversation_history):
-    """Handles the chat request, incorporating search and OpenAI completion."""
-    logger.info(f"Received user message: {user_message}")
-    
     # Augment with search results if search client is available
-    search_results_text = ""
-    if search_client:
-        documents = search_documents(user_message)
+    turn_context = []
+    if search:
+        documents = await search
         if documents:
-            search_results_text = "\n\nRelevant documents:\n"
-            for doc in documents:
-                search_results_text += f"- {doc.get('title', 'Document')} (Source: {doc.get('source', 'N/A')}): {doc.get('content', '')[:200]}...\n" # Truncate content for brevity
+            turn_context.append({"role": "system", "content": format_context(documents)})
     
-    # Prepare messages for OpenAI
-    messages = [{"role": "system", "content": "You are a helpful AI assistant."}]
+    # Prepare messages for OpenAI. The system prompt and the conversation history stay identical from turn to turn,
+    # so they go first and form the prefix the service can reuse from its prompt cache. The search results change
+    # with every query, so they go last, right before the user turn.
+    messages = [SYSTEM_MESSAGE]
     messages.extend(conversation_history) # Add past conversation
-    messages.append({"role": "user", "content": user_message + search_results_text})
+    messages.extend(turn_context)
+    messages.append({"role": "user", "content": user_message})
+    return messages, conversation_history
 
+
+@lru_cache(maxsize=1)
+def _token_encoding():
+    """Loads the tokenizer once. Returns None if it is unavailable (e.g. no network to fetch its vocabulary)."""
+    try:
+        return tiktoken.encoding_for_model("gpt-4o")
+    except Exception as e:
+        logger.warning(f"Could not load tokenizer, estimating token counts instead: {e}")
+        return None
+
+def count_message_tokens(message):
+    """Counts the prompt tokens a chat message uses, including a small per-message overhead."""
+    content = message.get("content") or ""
+    encoding = _token_encoding()
+    return (len(encoding.encode(content)) if encoding else len(content) // 4) + 4
+
+def summarize_history(conversation_history):
+    """
+    Replaces all but the most recent turns with a single summary message produced by a short completion.
+    Returns the history unchanged if summarization fails.
+    """
+    older = conversation_history[:-SUMMARY_KEEP_RECENT_TURNS]
+    recent = conversation_history[-SUMMARY_KEEP_RECENT_TURNS:]
+    transcript = "\n".join(f"{turn.get('role')}: {turn.get('content')}" for turn in older)
     try:
-        logger.info("Sending request to Azure OpenAI...")
         completion = openai_client.chat.completions.create(
             model=AZURE_OPENAI_DEPLOYMENT_NAME,
-            messages=messages,
-            max_tokens=800, # Adjust as needed
-            temperature=0.7
+            messages=[
+                {"role": "system", "content": "Summarize the following conversation in a few sentences, keeping facts the user may refer back to."},
+                {"role": "user", "content": transcript}
+            ],
+            max_tokens=200,
+            temperature=0
         )
-        assistant_response = completion.choices[0].message.content
+    except Exception as e:
+        logger.error(f"Error summarizing conversation history: {e}")
+        return conversation_history
+    logger.info(f"Summarized {len(older)} older turns of conversation history.")
+    return [{"role": "system", "content": SUMMARY_PREFIX + completion.choices[0].message.content}] + recent
+
+def trim_conversation_history(conversation_history):
+    """
+    Bounds the client-supplied history so prompt size doesn't grow with the session.
+    Long histories are summarized, then the oldest turns are dropped until the rest fits MAX_HISTORY_TOKENS.
+    A leading summary message is always kept.
+    """
+    if len(conversation_history) > SUMMARIZE_AFTER_TURNS:
+        conversation_history = summarize_history(conversation_history)
+
+    has_summary = bool(conversation_history) and str(conversation_history[0].get("content", "")).startswith(SUMMARY_PREFIX)
+    pinned = conversation_history[:1] if has_summary else []
+    turns = conversation_history[len(pinned):]
+    token_counts = [count_message_tokens(turn) for turn in conversation_history]
+    total_tokens = sum(token_counts)
+    dropped = 0
+    while total_tokens > MAX_HISTORY_TOKENS and dropped < len(turns):
+        total_tokens -= token_counts[len(pinned) + dropped]
+        dropped += 1
+    if dropped:
+        logger.info(f"Dropped {dropped} oldest turns to keep conversation history within {MAX_HISTORY_TOKENS} tokens.")
+    return pinned + turns[dropped:]
+
+
+def create_chat_completion_stream(messages):
+    """Starts a streaming chat completion on Azure OpenAI."""
+    logger.info("Sending request to Azure OpenAI...")
+    return openai_client.chat.completions.create(
+        model=AZURE_OPENAI_DEPLOYMENT_NAME,
+        messages=messages,
+        max_tokens=800, # Adjust as needed
+        temperature=0.7,
+        stream=True,
+        stream_options={"include_usage": True} # Final chunk reports token usage, including prompt cache hits
+    )
+
+
+def chunk_text(chunk):
+    """Returns the text delta of a streamed completion chunk, logging token usage when the chunk carries it."""
+    if chunk.usage and chunk.usage.prompt_tokens_details:
+        logger.info(f"Prompt tokens: {chunk.usage.prompt_tokens}, cached: {chunk.usage.prompt_tokens_details.cached_tokens}")
+    if not chunk.choices:
+        return "" # Azure sends content filter results and usage in chunks without choices
+    return chunk.choices[0].delta.content or ""
+
+
+def split_at_last_terminator(text):
+    """Splits text after its last sentence boundary. Returns (complete sentences, unfinished remainder)."""
+    last_boundary = None
+    for last_boundary in SENTENCE_BOUNDARY.finditer(text):
+        pass
+    if last_boundary is None:
+        return "", text
+    return text[:last_boundary.end()], text[last_boundary.end():]
+
+
+async def handle_chat_request(user_message, conversation_history):
+    """
+    Handles the chat request, incorporating search and OpenAI completion.
+    The completion is streamed so TTS for the first sentence overlaps with generation of the rest.
+    """
+    logger.info(f"Received user message: {user_message}")
+    loop = asyncio.get_running_loop()
+    messages, conversation_history = await build_chat_messages(user_message, conversation_history)
+
+    first_sentence = ""
+    first_sentence_audio = None
+    try:
+        completion = await loop.run_in_executor(EXECUTOR, create_chat_completion_stream, messages)
+        response_parts = []
+        # Pull chunks on the executor so the first-sentence TTS task keeps running on the event loop
+        chunks = iter(completion)
+        while (chunk := await loop.run_in_executor(EXECUTOR, next, chunks, None)) is not None:
+            response_parts.append(chunk_text(chunk))
+            if SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION and first_sentence_audio is None:
+                boundary = SENTENCE_BOUNDARY.search("".join(response_parts))
+                if boundary:
+                    first_sentence = "".join(response_parts)[:boundary.end()]
+                    logger.info("Synthesizing the first sentence while the completion continues.")
+                    first_sentence_audio = asyncio.create_task(synthesize_speech(first_sentence))
+        assistant_response = "".join(response_parts)
         logger.info(f"Received response from Azure OpenAI: {assistant_response[:100]}...")
 
-        audio_data_base64 = None
+        audio_url = None
         if SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION:
             logger.info("Attempting to synthesize audio for the response.")
-            audio_data_base64 = tts_ssml_and_send_audio_if_needed(assistant_response)
+            remaining_text = assistant_response[len(first_sentence):].strip()
+            tts_tasks = []
+            if first_sentence_audio is not None:
+                tts_tasks.append(first_sentence_audio)
+            if remaining_text:
+                tts_tasks.append(asyncio.create_task(synthesize_speech(remaining_text)))
+            audio_segments = await asyncio.gather(*tts_tasks)
+            # MP3 frames can be concatenated, so the segments play back as one clip
+            if audio_segments and all(audio_segments):
+                audio_url = f"/tts/{audio_store.put(b''.join(audio_segments))}"
         
         return {
             "text": assistant_response,
-            "audio": audio_data_base64, # This will be null if SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION is false or TTS fails
+            "audio_url": audio_url, # This will be null if SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION is false or TTS fails
             "conversation_history": conversation_history + [{"role": "user", "content": user_message}, {"role": "assistant", "content": assistant_response}]
         }
 
     except Exception as e:
         logger.error(f"Error in OpenAI chat completion: {e}")
+        # Don't leave the first-sentence TTS running (and holding a pooled synthesizer) after a failure
+        if first_sentence_audio is not None and not first_sentence_audio.done():
+            first_sentence_audio.cancel()
         return {"error": str(e), "text": "Sorry, I encountered an error.", "conversation_history": conversation_history}
 
 
+class AudioStore:
+    """
+    Short-lived hand-off of audio to the /tts/<uid> endpoint, so chat responses don't carry base64 audio.
+    Entries live in a SQLite file, so any worker process on the host can serve a URL issued by another.
+    Entries are either synthesized MP3 bytes or text still to be synthesized. They are removed when read or once expired.
+    """
+
+    def __init__(self, path, ttl=AUDIO_STORE_TTL):
+        self.ttl = ttl
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL") # Lets several workers read while one writes
+            self._conn.execute("CREATE TABLE IF NOT EXISTS audio (uid TEXT PRIMARY KEY, created_at REAL, text TEXT, mp3 BLOB)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS audio_created_at ON audio (created_at)")
+
+    def put(self, payload):
+        """Stores MP3 bytes or text to synthesize and returns its uid."""
+        uid = uuid.uuid4().hex
+        now = time.time()
+        text, mp3 = (payload, None) if isinstance(payload, str) else (None, payload)
+        with self._lock, self._conn:
+            # Evict entries the client never fetched
+            if now - self._last_purge > CACHE_DB_PURGE_INTERVAL:
+                self._conn.execute("DELETE FROM audio WHERE created_at < ?", (now - self.ttl,))
+                self._last_purge = now
+            self._conn.execute("INSERT INTO audio (uid, created_at, text, mp3) VALUES (?, ?, ?, ?)", (uid, now, text, mp3))
+        return uid
+
+    def pop(self, uid):
+        """Removes and returns the payload for uid, or None if it is unknown or expired."""
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT created_at, text, mp3 FROM audio WHERE uid = ?", (uid,)).fetchone()
+            # Only the request that actually deletes the row gets it, even if another worker raced for the same uid
+            if row is None or self._conn.execute("DELETE FROM audio WHERE uid = ?", (uid,)).rowcount != 1:
+                return None
+        created_at, text, mp3 = row
+        if time.time() - created_at > self.ttl:
+            return None
+        return text if text is not None else mp3
+
+audio_store = AudioStore(AUDIO_STORE_PATH)
+
+
 @app.route('/')
 def index():
     """Serves the main HTML page."""
-    return render_template ('index.html', should_stream_audio=SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION, azure_speech_region=SPEECH_REGION)
+    return render_template ('index.html', should_stream_audio=SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION, should_stream_tts_chunks=SHOULD_STREAM_TTS_CHUNKS, azure_speech_region=SPEECH_REGION)
 
 
 @app.route('/static/<path:path>')
@@ -218,7 +919,7 @@ def send_static(path):
 
 
 @app.route('/chat', methods=['POST'])
-def chat():
+async def chat():
     """Handles chat messages from the client."""
     try:
         data = request.get_json()
@@ -228,40 +929,129 @@ def chat():
         if not user_message:
             return jsonify({"error": "Empty message received"}), 400
 
-        response_data = handle_chat_request(user_message, conversation_history)
-        return jsonify(response_data)
+        response_data = await handle_chat_request(user_message, conversation_history)
+        # orjson is several times faster than the stdlib encoder
+        return Response(orjson.dumps(response_data), mimetype='application/json')
 
     except Exception as e:
         logger.error(f"Error in /chat endpoint: {e}")
         return jsonify({"error": "An internal server error occurred", "text": "Sorry, something went wrong on the server."}), 500
 
 
+@app.route('/chat_stream', methods=['POST'])
+async def chat_stream():
+    """
+    Handles chat messages from the client, streaming the reply as newline-delimited JSON.
+    Each sentence is sent as a {"text_delta": ..., "audio_url": ...} line as soon as the model finishes it.
+    The audio is synthesized and streamed when the client fetches audio_url, so text keeps flowing meanwhile.
+    The last line carries the full text and conversation history.
+    """
+    try:
+        data = request.get_json()
+        user_message = data.get('message')
+        conversation_history = data.get('conversation_history', [])
+
+        if not user_message:
+            return jsonify({"error": "Empty message received"}), 400
+
+        logger.info(f"Received user message: {user_message}")
+        messages, conversation_history = await build_chat_messages(user_message, conversation_history)
+    except Exception as e:
+        logger.error(f"Error in /chat_stream endpoint: {e}")
+        return jsonify({"error": "An internal server error occurred", "text": "Sorry, something went wrong on the server."}), 500
+
+    response_parts = []
+
+    def sentence_frame(sentence):
+        response_parts.append(sentence)
+        frame = {"text_delta": sentence}
+        if SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION and sentence.strip():
+            frame["audio_url"] = f"/tts/{audio_store.put(sentence.strip())}"
+        return orjson.dumps(frame) + b"\n"
+
+    def generate():
+        # The completion is read on the request thread, so a client that disconnects also stops the completion
+        pending = ""
+        try:
+            for chunk in create_chat_completion_stream(messages):
+                pending += chunk_text(chunk)
+                complete, pending = split_at_last_terminator(pending)
+                if complete:
+                    yield sentence_frame(complete)
+            if pending:
+                yield sentence_frame(pending)
+        except Exception as e:
+            logger.error(f"Error in OpenAI chat completion: {e}")
+            yield orjson.dumps({"error": str(e), "text": "Sorry, I encountered an error.", "conversation_history": conversation_history}) + b"\n"
+            return
+
+        assistant_response = "".join(response_parts)
+        logger.info(f"Streamed response from Azure OpenAI: {assistant_response[:100]}...")
+        yield orjson.dumps({
+            "text": assistant_response,
+            "conversation_history": conversation_history + [{"role": "user", "content": user_message}, {"role": "assistant", "content": assistant_response}]
+        }) + b"\n"
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/tts/<uid>', methods=['GET'])
+def get_tts_audio(uid):
+    """Serves the MP3 audio referenced by a chat response. Each audio URL can only be fetched once."""
+    payload = audio_store.pop(uid)
+    if payload is None:
+        return jsonify({"error": "Audio not found or expired"}), 404
+    # Text is synthesized now, streaming the audio out as it is produced
+    audio = tts_ssml_stream_audio_chunks(payload) if isinstance(payload, str) else payload
+    return Response(audio, mimetype='audio/mpeg', headers={'Cache-Control': 'no-store'})
+
+
+@app.route('/debug/cache', methods=['GET'])
+def debug_cache():
+    """Reports hit/miss statistics for the in-memory caches."""
+    return jsonify({"embeddings": _embed_cached.cache_info()._asdict(), "semantic": semantic_cache.stats()})
+
+
+_sts_token_cache = {"token": None, "issued_at": 0.0}
+_sts_token_lock = threading.Lock()
+
+def get_speech_token():
+    """
+    Returns a Speech service authorization token and its remaining lifetime in seconds.
+    A new token is only issued when the cached one is about to expire.
+    """
+    with _sts_token_lock:
+        age = time.time() - _sts_token_cache["issued_at"]
+        if _sts_token_cache["token"] and age < STS_TOKEN_REFRESH_AFTER:
+            return _sts_token_cache["token"], int(STS_TOKEN_LIFETIME - age)
+        response = shared_http_client.post(
+            f"https://{SPEECH_REGION}.api.cognitive.microsoft.com/sts/v1.0/issueToken",
+            headers={"Ocp-Apim-Subscription-Key": SPEECH_KEY}
+        )
+        response.raise_for_status()
+        _sts_token_cache["token"] = response.text
+        _sts_token_cache["issued_at"] = time.time()
+        logger.info("Issued a new Speech service authorization token.")
+        return _sts_token_cache["token"], STS_TOKEN_LIFETIME
+
+
 @app.route('/sts_token', methods=['GET'])
 def get_sts_token():
-    """Provides a Speech SDK token for client-side speech-to-text."""
-    # This is a simplified token generation for example purposes.
-    # In a production environment, you should use a more secure token service.
-    # The Speech SDK can use the subscription key directly on the client for STT,
-    # but using a token is generally recommended for better security if the key is not to be exposed.
-    # However, for simplicity and common practice in samples, often the key itself is used by client if it has access.
-    # This endpoint simulates fetching a short-lived token.
-    
-    # For this example, we'll just return the key and region if they are set,
-    # as the client JS SDK can use them directly.
-    # A true STS token would be fetched from the Azure STS service.
+    """Provides a short-lived Speech SDK authorization token for client-side speech-to-text, so the subscription key never reaches the browser."""
     if not SPEECH_KEY or not SPEECH_REGION:
         return jsonify({"error": "Speech key or region not configured on the server."}), 500
-    
-    # The client-side Speech SDK can be configured with a subscription key and region directly.
-    # If you need to generate an authorization token, you would make a request to:
-    # https://<REGION>.api.cognitive.microsoft.com/sts/v1.0/issueToken
-    # with Ocp-Apim-Subscription-Key header.
-    # For this sample, we'll just pass the necessary info for the client to init.
-    return jsonify({'token': SPEECH_KEY, 'region': SPEECH_REGION})
+    try:
+        token, expires_in = get_speech_token()
+    except Exception as e:
+        logger.error(f"Error issuing Speech service token: {e}")
+        return jsonify({"error": "Could not issue a speech token."}), 500
+    # expires_in lets the client refresh before this (possibly cached) token runs out
+    return jsonify({'token': token, 'region': SPEECH_REGION, 'expires_in': expires_in})
 
 
 if __name__ == '__main__':
+    # Flask's built-in server is for development only. In production, serve wsgi:app with Gunicorn (see NOTES.txt).
+    if os.environ.get("FLASK_ENV") == "production":
+        raise SystemExit("Refusing to start the development server with FLASK_ENV=production. Run: gunicorn -c gunicorn.conf.py wsgi:app")
     logger.info(f"Flask app starting on port {PORT}")
-    # Note: For production, use a proper WSGI server like Gunicorn or Waitress.
-    # Flask's built-in server is for development only.
     app.run(host='0.0.0.0', port=int(PORT), debug=False) # debug=False for production-like logging
\ No newline at end of file
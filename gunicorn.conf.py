@@ -0,0 +1,16 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+# Gunicorn settings for serving wsgi:app in production.
+# Every /chat request spends its time waiting on Azure (embeddings, search, completion, TTS),
+# so each worker process runs many threads to serve concurrent sessions.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+# Audio behind /tts/<uid> is handed off through a SQLite file (AUDIO_STORE_PATH), so any worker can serve it
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
+timeout = 120 # Long replies stream for a while
+keepalive = 5
@@ -13,11 +13,16 @@ document.addEventListener("DOMContentLoaded", () => {
     // These values are now passed from the template
      const SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION_BROWSER = window.SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION_BROWSER;
      const AZURE_SPEECH_REGION_BROWSER = window.AZURE_SPEECH_REGION_BROWSER;
+     const SHOULD_STREAM_TTS_CHUNKS_BROWSER = window.SHOULD_STREAM_TTS_CHUNKS_BROWSER;
+
+    const TOKEN_REFRESH_MARGIN_SECONDS = 60; // Refresh this long before the token expires
+    const TOKEN_RETRY_SECONDS = 30;
 
     let speechRecognizer;
-    let audioContext;
-    let audioQueue = [];
-    let isPlaying = false;
+    const MAX_LOADING_AUDIO_CLIPS = 2; // The playing clip plus one being prefetched; bounds parallel /tts requests
+
+    let audioQueue = []; // Audio URLs not yet loading, in playback order
+    let audioClips = []; // <audio> elements loading or playing; the first one is playing
     let conversationHistory = []; // Stores the history of the conversation
 
     // Initialize Speech Recognizer if keys are available
@@ -29,16 +34,35 @@ document.addEventListener("DOMContentLoaded", () => {
         updateStatus("Speech-to-text disabled (config missing).", "warning");
     }
 
-    function initializeSpeechRecognizer() {
-        // Fetch token from backend - this example uses key directly for simplicity in some SDK versions
-        // but a token endpoint is better practice. The python sample uses /sts_token
-        fetch('/sts_token')
+    function fetchSpeechToken() {
+        return fetch('/sts_token')
             .then(response => {
                 if (!response.ok) {
                     throw new Error(`Failed to fetch STS token: ${response.statusText}`);
                 }
                 return response.json();
-            })
+            });
+    }
+
+    // The server may hand out a cached token, so refresh based on the lifetime it reports rather than a fixed interval
+    function scheduleTokenRefresh(expiresIn) {
+        const delaySeconds = Math.max((expiresIn || 0) - TOKEN_REFRESH_MARGIN_SECONDS, TOKEN_RETRY_SECONDS);
+        setTimeout(() => {
+            fetchSpeechToken()
+                .then(refreshed => {
+                    if (refreshed.token) speechRecognizer.authorizationToken = refreshed.token;
+                    scheduleTokenRefresh(refreshed.expires_in);
+                })
+                .catch(error => {
+                    console.error("Failed to refresh speech token:", error);
+                    scheduleTokenRefresh(0); // Retry soon
+                });
+        }, delaySeconds * 1000);
+    }
+
+    function initializeSpeechRecognizer() {
+        // Fetch a short-lived authorization token from the backend, which keeps the subscription key server-side
+        fetchSpeechToken()
             .then(data => {
                 if (data.error) {
                     console.error("Error fetching STS token:", data.error);
@@ -47,7 +71,7 @@ document.addEventListener("DOMContentLoaded", () => {
                     return;
                 }
 
-                const speechConfig = SpeechSDK.SpeechConfig.fromSubscription(data.token, data.region);
+                const speechConfig = SpeechSDK.SpeechConfig.fromAuthorizationToken(data.token, data.region);
                 speechConfig.speechRecognitionLanguage = "en-US"; // Or make configurable
                 const audioConfig = SpeechSDK.AudioConfig.fromDefaultMicrophoneInput();
                 speechRecognizer = new SpeechSDK.SpeechRecognizer(speechConfig, audioConfig);
@@ -101,6 +125,8 @@ document.addEventListener("DOMContentLoaded", () => {
                     sendButton.disabled = false;
                 };
 
+                scheduleTokenRefresh(data.expires_in);
+
                 if (recordButton) recordButton.disabled = false;
                 console.log("Speech recognizer initialized.");
                 updateStatus("Ready for speech input.", "info");
@@ -142,7 +168,7 @@ document.addEventListener("DOMContentLoaded", () => {
         sendButton.disabled = true;
         chatInput.disabled = true;
 
-        fetch("/chat", {
+        fetch(SHOULD_STREAM_TTS_CHUNKS_BROWSER ? "/chat_stream" : "/chat", {
             method: "POST",
             headers: { "Content-Type": "application/json" },
             body: JSON.stringify({ message: message, conversation_history: conversationHistory.slice(0, -1) }) // Send history *before* current user message
@@ -156,10 +182,12 @@ document.addEventListener("DOMContentLoaded", () => {
                     throw new Error(`HTTP error ${response.status} - ${response.statusText}`);
                 });
             }
-            return response.json();
+            if (SHOULD_STREAM_TTS_CHUNKS_BROWSER) {
+                return readChatStream(response);
+            }
+            return response.json().then(data => handleMessage(data));
         })
-        .then(data => {
-            handleMessage(data);
+        .then(() => {
             updateStatus("Message received.", "info");
         })
         .catch(error => {
@@ -174,6 +202,51 @@ document.addEventListener("DOMContentLoaded", () => {
         });
     }
 
+    // Reads the newline-delimited JSON stream from /chat_stream.
+    // Sentences arrive as text_delta frames, each with the URL of its audio;
+    // the final frame carries the full text and conversation history.
+    function readChatStream(response) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffered = "";
+        let messageElement = null;
+
+        const handleFrame = (line) => {
+            if (!line.trim()) return;
+            const frame = JSON.parse(line);
+            if (frame.text_delta !== undefined) {
+                if (!messageElement) {
+                    messageElement = document.createElement("div");
+                    messageElement.classList.add("mb-2", "p-3", "rounded-lg", "max-w-3/4", "break-words", "bg-gray-200", "dark:bg-gray-700", "text-gray-800", "dark:text-gray-200", "self-start", "mr-auto");
+                    chatBox.appendChild(messageElement);
+                }
+                messageElement.textContent += frame.text_delta;
+                chatBox.scrollTop = chatBox.scrollHeight;
+                if (SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION_BROWSER && frame.audio_url) {
+                    queueAudioUrl(frame.audio_url);
+                }
+            } else if (frame.error || !messageElement) {
+                handleMessage(frame);
+            } else if (frame.conversation_history) {
+                // The reply is already on screen; just adopt the server's history
+                conversationHistory = frame.conversation_history;
+            }
+        };
+
+        const pump = () => reader.read().then(({ done, value }) => {
+            if (done) {
+                handleFrame(buffered);
+                return;
+            }
+            buffered += decoder.decode(value, { stream: true });
+            const lines = buffered.split("\n");
+            buffered = lines.pop(); // Keep the incomplete trailing line for the next read
+            lines.forEach(handleFrame);
+            return pump();
+        });
+        return pump();
+    }
+
     function handleMessage(message) {
         if (message.error) {
             console.error("Received error from server:", message.error);
@@ -192,59 +265,52 @@ document.addEventListener("DOMContentLoaded", () => {
 
 
         // Play audio if SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION_BROWSER is true and audio data is present
-        if (SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION_BROWSER && message.audio) {
-            try {
-                const audioData = base64ToArrayBuffer(message.audio);
-                playAudioQueue(audioData);
-            } catch (e) {
-                console.error("Error processing audio data:", e);
-                updateStatus("Error playing audio.", "error");
-            }
+        if (SHOULD_STREAM_AUDIO_FROM_CHAT_COMPLETION_BROWSER && message.audio_url) {
+            queueAudioUrl(message.audio_url);
         }
     }
 
-    function base64ToArrayBuffer(base64) {
-        const binaryString = window.atob(base64);
-        const len = binaryString.length;
-        const bytes = new Uint8Array(len);
-        for (let i = 0; i < len; i++) {
-            bytes[i] = binaryString.charCodeAt(i);
-        }
-        return bytes.buffer;
+    // Audio is streamed as raw MP3 from the /tts endpoint into <audio> elements, so playback starts while
+    // the clip is still being synthesized. Clips play in the order their URLs arrived, and only the playing
+    // clip and the next one are loaded at a time.
+    function queueAudioUrl(url) {
+        audioQueue.push(url);
+        loadAudioClips();
     }
 
-    function playAudioQueue(arrayBuffer) {
-        if (!audioContext) {
-            audioContext = new (window.AudioContext || window.webkitAudioContext)();
+    function loadAudioClips() {
+        while (audioClips.length < MAX_LOADING_AUDIO_CLIPS && audioQueue.length > 0) {
+            const clip = new Audio();
+            clip.preload = "auto";
+            clip.onended = () => playNextAudioClip(clip);
+            clip.onerror = () => {
+                console.error("Error playing audio clip:", clip.error);
+                updateStatus("Error playing audio.", "error");
+                playNextAudioClip(clip);
+            };
+            clip.src = audioQueue.shift();
+            audioClips.push(clip);
         }
-        audioQueue.push(arrayBuffer);
-        if (!isPlaying) {
-            playNextInQueue();
+        if (audioClips.length > 0 && audioClips[0].paused && !audioClips[0].ended) {
+            audioClips[0].play().catch(e => console.error("Error starting audio playback:", e));
         }
     }
 
-    function playNextInQueue() {
-        if (audioQueue.length === 0) {
-            isPlaying = false;
-            return;
-        }
-        isPlaying = true;
-        const arrayBuffer = audioQueue.shift();
-
-        audioContext.decodeAudioData(arrayBuffer, (buffer) => {
-            const source = audioContext.createBufferSource();
-            source.buffer = buffer;
-            source.connect(audioContext.destination);
-            source.start(0);
-            source.onended = () => {
-                playNextInQueue();
-            };
-        }, (error) => {
-            console.error("Error decoding audio data:", error);
-            updateStatus("Error playing audio.", "error");
-            isPlaying = false; // Ensure we can try playing next if this one fails
-            playNextInQueue(); // Try next item
+    function playNextAudioClip(finishedClip) {
+        audioClips = audioClips.filter(clip => clip !== finishedClip);
+        loadAudioClips();
+    }
+
+    function stopAudio() {
+        audioQueue = [];
+        audioClips.forEach(clip => {
+            clip.onended = null;
+            clip.onerror = null;
+            clip.pause();
+            clip.removeAttribute("src");
+            clip.load(); // Aborts the download
         });
+        audioClips = [];
     }
     
     function updateStatus(message, type = "info") {
@@ -306,12 +372,7 @@ document.addEventListener("DOMContentLoaded", () => {
         clearChatButton.addEventListener("click", () => {
             chatBox.innerHTML = "";
             conversationHistory = [];
-            audioQueue = []; // Clear any pending audio
-            if (isPlaying && audioContext) {
-                // This is a bit tricky, ideally, you'd stop the current sound
-                // For simplicity, we're just clearing the queue.
-                // A more robust solution might involve stopping the current AudioBufferSourceNode.
-            }
+            stopAudio(); // Stop the current clip and drop any pending audio
             updateStatus("Chat cleared.", "info");
         });
     }
@@ -0,0 +1,7 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+# Production entry point: gunicorn -c gunicorn.conf.py wsgi:app
+from app import app
+
+__all__ = ["app"]